@@ -1,6 +1,19 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
+import json
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import duckdb
+import openai
+from dotenv import load_dotenv
+
 # 載入 .env 文件中的環境變量
 load_dotenv()
 
@@ -21,26 +34,19 @@ asin_list = [
     "B007CE373O"
 ]
 max_count = 1000001
+flush_rows = 10000  # 評分結果累積到此筆數後寫入 DuckDB
+source_batch_rows = 4096  # 評分時每次從來源檔讀入的評論筆數
 
 # 定義檔案路徑
 rating_path_feather = Path(f'{GPTfolder}/Comment_Property_Rating_{filename}_Dta.feather')
-rating_path_xlsx = Path(f'{GPTfolder}/Comment_Property_Rating_{filename}_Dta.xlsx')
+rating_path_parquet = Path(f'{GPTfolder}/Comment_Property_Rating_{filename}_Dta.parquet')
 ratingonly_path_feather = Path(f'{GPTfolder}/Comment_Property_Ratingonly_{filename}_Dta.feather')
-ratingonly_path_xlsx = Path(f'{GPTfolder}/Comment_Property_Ratingonly_{filename}_Dta.xlsx')
-temp_folder_path = os.path.join(GPTfolder, 'temp')
-if not os.path.exists(temp_folder_path):
-    os.makedirs(temp_folder_path)
-    print(f"Created temp folder at {temp_folder_path}")
-else:
-    print(f"Temp folder already exists at {temp_folder_path}")
+ratingonly_path_parquet = Path(f'{GPTfolder}/Comment_Property_Ratingonly_{filename}_Dta.parquet')
+score_db_path = Path(f'{GPTfolder}/Comment_Property_Rating_{filename}_Dta.duckdb')
+score_path_parquet = Path(f'{GPTfolder}/Comment_Property_Rating_{filename}_Score.parquet')
 
 # -----------------------------
-# 讀取資料
-print("讀取商品評論資料...")
-Property_Rating = pd.read_feather(rating_path_feather)
-print(f"總共有 {len(Property_Rating)} 筆評論資料。")
-
-# 讀取屬性定義檔 (Excel)
+# 讀取屬性定義檔 (Excel)；評論資料於評分時才以串流方式逐批讀取
 print("讀取屬性定義檔...")
 Property = pd.read_excel(Path(f'{GPTfolder}/Comment_Property_{filename}_Dta.xlsx'))
 print(Property.head())
@@ -50,109 +56,258 @@ print(Property.head())
 api_key = os.getenv("OPENAI_API_KEY")
 if api_key is None:
     raise ValueError("API key not found. Please set the OPENAI_API_KEY environment variable.")
-openai.api_key = api_key
+client = openai.OpenAI(api_key=api_key)
 
 # -----------------------------
 # 定義輔助函式
 
-def save_to_feather_with_timestamp(df, folder_path):
-    """將 DataFrame 存成帶有時間戳記的 feather 檔案"""
-    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    file_path = os.path.join(folder_path, f"{timestamp}.feather")
-    try:
-        df.to_feather(file_path)
-        print(f"Data successfully saved to {file_path}")
-    except Exception as e:
-        print(f"Error saving file: {e}")
+def init_score_db(db_path):
+    """開啟評分暫存資料庫；每筆 (評論, 屬性) 的回應都會寫入 comment_score"""
+    con = duckdb.connect(str(db_path))
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS comment_score (
+          row_id    BIGINT,
+          ASIN      TEXT,
+          property  TEXT,
+          response  TEXT,
+          scored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return con
+
+def flush_scores(con, buffer):
+    """將暫存的評分結果一次寫入 DuckDB 並清空 buffer"""
+    if not buffer:
+        return
+    con.append("comment_score", pd.DataFrame(buffer), by_name=True)
+    print(f"已寫入 {len(buffer)} 筆評分至 {score_db_path}")
+    buffer.clear()
+
+def replay_scores(con, df, property_names):
+    """將先前中斷時已寫入 DuckDB 的評分補回 df 中仍為空的欄位"""
+    logged = con.execute("""
+        SELECT row_id, ASIN, property, arg_max(response, scored_at) AS response
+        FROM comment_score
+        GROUP BY row_id, ASIN, property
+    """).df()
+    # 以 ASIN 檢查 row_id 仍對應同一筆評論，避免來源檔更動後錯置
+    logged = logged[logged['row_id'].isin(df.index)]
+    logged = logged[df.loc[logged['row_id'], 'ASIN'].to_numpy() == logged['ASIN'].to_numpy()]
+    if logged.empty:
+        return
+    replay = logged.pivot(index='row_id', columns='property', values='response')
+    # 本次評分已併回的欄位也在 comment_score 中，只計算實際由 fillna 補上的儲存格
+    filled = 0
+    for col in replay.columns.intersection(property_names):
+        empty = df[col].isna()
+        df[col] = df[col].fillna(replay[col].reindex(df.index))
+        filled += int((empty & df[col].notna()).sum())
+    if filled:
+        print(f"已從 {score_db_path} 補回 {filled} 筆評分。")
+
+def export_parquet(con, df, path):
+    """以 DuckDB COPY 將 DataFrame 輸出為 ZSTD 壓縮的 parquet"""
+    con.register("export_df", df)
+    con.execute(f"COPY export_df TO '{path}' (FORMAT PARQUET, COMPRESSION ZSTD)")
+    con.unregister("export_df")
+
+def rating_schema(property_names):
+    """一次評分多個屬性的 structured output JSON schema"""
+    return {
+        "name": "property_ratings",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "ratings": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "property": {"type": "string", "enum": list(property_names)},
+                            "score": {"type": ["integer", "null"]},
+                            "reason": {"type": "string"}
+                        },
+                        "required": ["property", "score", "reason"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["ratings"],
+            "additionalProperties": False
+        }
+    }
+
+def rate_comment_all(title, body, property_names, model="gpt-4o-mini"):
+    """
+    以單次 GPT 請求評分一筆評論的所有屬性。
+    回傳 {屬性: (分數, 理由)}，未提及的屬性分數為 None。
+    """
+    property_list = "\n".join(f"- {p}" for p in property_names)
+    prompt = (
+        f"「{body}」, 顧客評論標題：「{title}」。\n"
+        f"請問這個人覺得這個產品的下列各屬性如何？\n{property_list}\n"
+        f"請針對每個屬性評分符合的程度：0 代表非常不符合、10 代表非常符合；"
+        f"如果評論中未提及該屬性，score 請填 null。\n"
+        f"每個屬性皆需回傳 property、score 與 reason。"
+    )
+    completion = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_schema", "json_schema": rating_schema(property_names)}
+    )
+    ratings = json.loads(completion.choices[0].message.content)["ratings"]
+    return {r["property"]: (r["score"], r["reason"]) for r in ratings}
+
+def format_rating(score, reason):
+    """Property_Rating 欄位沿用的「分數,理由」文字格式"""
+    return f"{'NaN' if score is None else score},{reason}"
 
 # -----------------------------
-# 屬性評分：針對每個屬性直接進行評分（不依賴 Analysis 欄位）
-for idx, row in Property.iterrows():
-    propertyname = row['Property']
-    print(f"\n正在評分屬性：{propertyname}")
+# 屬性評分：每筆評論一次請求評分所有屬性（不依賴 Analysis 欄位）
+property_names = Property['Property'].tolist()
+print(f"\n正在評分屬性：{', '.join(property_names)}")
 
-    # 若 Property_Rating 中沒有此屬性欄位，則新增
-    if propertyname not in Property_Rating.columns:
-        Property_Rating[propertyname] = pd.NA
+con = init_score_db(score_db_path)
+score_buffer = []
+results = {}  # {indexc: {屬性: (分數, 理由)}}，迴圈結束後一次併回 Property_Rating
+
+count = 0
+start_time = time.perf_counter()
 
-    count = 0
-    start_time = time.perf_counter()
-
-    # 依序針對每筆評論進行評分
-    for indexc, rowc in Property_Rating.iterrows():
-        # 僅對 asin_list 中的商品進行評分
-        if rowc['ASIN'] in asin_list and pd.isna(rowc[propertyname]):
-            try:
-                prompt = (
-                    f"「{rowc['Body']}」, 顧客評論標題：「{rowc['Title']}」。\n"
-                    f"請問這個人覺得這個產品的「{propertyname}」如何？\n"
-                    f"請針對符合該屬性的程度評分：0 代表非常不符合、10 代表非常符合；"
-                    f"如果評論中未提及該屬性，請填入 NaN。\n"
-                    f"請回傳結果格式為「分數,理由」。"
-                )
-                # 使用 GPT 模型進行評分（請根據需求修改 model 名稱）
-                completion = openai.ChatCompletion.create(
-                    model="gpt-4o-mini",
-                    messages=[{"role": "user", "content": prompt}]
-                )
-                response_text = completion.choices[0].message.content.strip()
-                Property_Rating.at[indexc, propertyname] = response_text
-                count += 1
-                if count % 20 == 1:
-                    save_to_feather_with_timestamp(Property_Rating, temp_folder_path)
-                    print(f"正在處理屬性 '{propertyname}'；目前索引：{indexc}；累計評分：{count}")
-            except Exception as e:
-                print(f"Error processing index {indexc}: {e}")
-            if count >= max_count:
-                break
+# 由 DuckDB 直接掃描 feather（Arrow IPC）檔，篩出 asin_list 中的商品並附上先前已寫入
+# comment_score 的屬性，以 Arrow record batch 逐批取回，記憶體只需容納一批評論。
+# row_id 即 pd.read_feather 後的列索引，須在篩選前依檔案順序編號
+source = ds.dataset(rating_path_feather, format="ipc")
+file_props = [p for p in property_names if p in source.schema.names]
+prop_select = "".join(f', s."{p}"' for p in file_props)
+scan = con.cursor()
+scan.register("source", source)
+reader = scan.sql(f"""
+    SELECT s.row_id, s.ASIN, s.Title, s.Body{prop_select}, l.logged
+    FROM (SELECT row_number() OVER () - 1 AS row_id, * FROM source) s
+    LEFT JOIN (SELECT row_id, ASIN, list(property) AS logged
+               FROM comment_score GROUP BY row_id, ASIN) l
+      ON l.row_id = s.row_id AND l.ASIN = s.ASIN
+    WHERE list_contains(?, s.ASIN)
+""", params=[asin_list]).to_arrow_reader(batch_size=source_batch_rows)
+
+# 依序針對每筆仍有屬性未評分的評論進行評分
+for batch in reader:
+    for row in batch.to_pylist():
+        logged = set(row['logged'] or ())
+        missing = [p for p in property_names if row.get(p) is None and p not in logged]
+        if not missing:
+            continue
+        indexc, asin = row['row_id'], row['ASIN']
+        try:
+            # 使用 GPT 模型進行評分（請根據需求修改 model 名稱）
+            ratings = rate_comment_all(row['Title'], row['Body'], missing)
+            prop_cols = [p for p in missing if p in ratings]
+            results[indexc] = {p: ratings[p] for p in prop_cols}
+            score_buffer.extend(
+                {"row_id": indexc, "ASIN": asin, "property": p, "response": format_rating(*ratings[p])}
+                for p in prop_cols
+            )
+            count += 1
+            if len(score_buffer) >= flush_rows:
+                flush_scores(con, score_buffer)
+                print(f"目前索引：{indexc}；累計評分：{count}")
+        except Exception as e:
+            print(f"Error processing index {indexc}: {e}")
         if count >= max_count:
             break
+    if count >= max_count:
+        break
+scan.unregister("source")
+scan.close()
+# 之後會覆寫同一個 feather 檔：先釋放 reader 與 dataset，不再持有該檔
+del reader, source
+flush_scores(con, score_buffer)
 
-    end_time = time.perf_counter()
-    elapsed_time = end_time - start_time
-    print(f"屬性 {propertyname} 評分完成，共 {count} 筆評分。")
-    print(f"總耗時：{round(elapsed_time, 3)} 秒；平均每筆耗時：{round(elapsed_time/max(count,1), 3)} 秒。")
+end_time = time.perf_counter()
+elapsed_time = end_time - start_time
+print(f"評分完成，共 {count} 筆評論。")
+print(f"總耗時：{round(elapsed_time, 3)} 秒；平均每筆耗時：{round(elapsed_time/max(count,1), 3)} 秒。")
+
+# -----------------------------
+# 評分結束後才讀入完整資料表，併回本次與先前寫入 DuckDB 的評分
+print("讀取商品評論資料...")
+Property_Rating = pd.read_feather(rating_path_feather)
+print(f"總共有 {len(Property_Rating)} 筆評論資料。")
+
+# 若 Property_Rating 中沒有此屬性欄位，則新增
+for propertyname in property_names:
+    if propertyname not in Property_Rating.columns:
+        Property_Rating[propertyname] = pd.NA
+
+# 一次將本次評分結果併回各屬性欄位；分數另存為 Int8 供「僅評分」版本直接使用
+scored = pd.DataFrame.from_dict(
+    {i: {p: format_rating(*r) for p, r in row.items()} for i, row in results.items()},
+    orient='index')
+scored_scores = pd.DataFrame.from_dict(
+    {i: {p: r[0] for p, r in row.items()} for i, row in results.items()},
+    orient='index').astype('Int8')
+if results:
+    for col in scored.columns:
+        Property_Rating[col] = (
+            scored[col].reindex(Property_Rating.index)
+            .combine_first(Property_Rating[col])
+            .astype('string[pyarrow]')
+        )
+replay_scores(con, Property_Rating, property_names)
 
 # -----------------------------
 # 儲存最終結果
 print("儲存最終結果...")
+con.execute(f"COPY comment_score TO '{score_path_parquet}' (FORMAT PARQUET)")
 Property_Rating.to_feather(rating_path_feather)
-Property_Rating.to_excel(rating_path_xlsx, index=False)
+export_parquet(con, Property_Rating, rating_path_parquet)
 
 # -----------------------------
-# 從評分結果中抽取純數字評分 (若需要)
-print("從評分結果中抽取數字評分...")
+# 產生純數字評分：本次評分直接使用 JSON 回傳的分數，
+# 僅先前留下的文字結果（舊版回應或中斷後補回者）需要從「分數,理由」中抽取
+print("整理數字評分...")
 
 # 先複製一份用來產生「僅評分」版本
 Property_Ratingonly = Property_Rating.copy()
 
-def find_number_or_nan(s):
-    # 檢查是否包含 'NaN' (不區分大小寫)
-    if isinstance(s, str) and ('nan' in s.lower()):
-        return np.nan
-    # 匹配 0~10 的數字（10 或單個數字）
-    match = re.search(r'\b(10|[0-9])\b', s) if isinstance(s, str) else None
-    if match:
-        return int(match.group())
-    else:
-        return np.nan
-
-def process_element(x):
-    if isinstance(x, str):
-        elements = re.split(r',|，', x)
-        return find_number_or_nan(elements[0])
-    else:
-        return np.nan
+def extract_scores(col):
+    """
+    以 Arrow compute kernel 從「分數,理由」中抽取 0~10 的分數，整欄在 C++ 中一次處理。
+    只看第一個逗號（含全形「，」）之前的部分；其中含 'NaN'（不區分大小寫）
+    或找不到數字時為 NA。
+    """
+    arr = pa.array(col.astype('string[pyarrow]'))
+    head = pc.struct_field(pc.extract_regex(arr, r'^(?P<head>[^,，]*)'), [0])
+    is_nan = pc.match_substring(head, 'nan', ignore_case=True)
+    digits = pc.struct_field(pc.extract_regex(head, r'(?P<n>\b(?:10|[0-9])\b)'), [0])
+    scores = pc.if_else(is_nan, pa.scalar(None, pa.int8()), pc.cast(digits, pa.int8()))
+    return scores.to_pandas(types_mapper={pa.int8(): pd.Int8Dtype()}.get).set_axis(col.index)
 
 # 只針對屬性欄位進行數字提取 (排除 key 欄位，若有 Analysis 欄位則也排除)
 property_cols = [col for col in Property_Ratingonly.columns if col not in ['ASIN', 'Title', 'Body', 'time', 'Analysis']]
 for col in property_cols:
-    if Property_Ratingonly[col].dtype == 'object':
-        Property_Ratingonly[col] = Property_Ratingonly[col].apply(process_element)
+    if not pd.api.types.is_string_dtype(Property_Ratingonly[col]):
+        continue
+    scores = pd.Series(pd.NA, index=Property_Ratingonly.index, dtype='Int8')
+    fresh = pd.Series(False, index=Property_Ratingonly.index)
+    if col in scored.columns:
+        fresh = scored[col].reindex(Property_Ratingonly.index).notna()
+        scores[fresh] = scored_scores[col].reindex(Property_Ratingonly.index)[fresh]
+    legacy = Property_Rating[col].notna() & ~fresh
+    if legacy.any():
+        scores[legacy] = extract_scores(Property_Rating.loc[legacy, col])
+    Property_Ratingonly[col] = scores
 
 # 儲存「僅評分」結果
-Property_Ratingonly.to_excel(ratingonly_path_xlsx, index=False)
+export_parquet(con, Property_Ratingonly, ratingonly_path_parquet)
 Property_Ratingonly.to_feather(ratingonly_path_feather)
+con.close()
+
+# 若需要 Excel，請只從 parquet 匯出篩選後的小量結果，例如：
+# duckdb.sql("SELECT * FROM read_parquet(?) WHERE ASIN = ?",
+#            params=[str(ratingonly_path_parquet), 'B0001YH1A2']).df().to_excel('B0001YH1A2.xlsx', index=False)
 
 print("評分結果：")
 print(Property_Ratingonly)
\ No newline at end of file
@@ -1,7 +1,73 @@
 # comment_per.py
+import atexit
+import asyncio
+from functools import lru_cache
+
+import httpx
 import openai
 
-def rate_comment(title, body, product_line_name, property_name, property_type, gpt_key, model="o4-mini"):
+@lru_cache(maxsize=4)
+def _get_client(gpt_key):
+    """同一金鑰共用一個 OpenAI 客戶端，讓連線池與 TLS 連線在多次呼叫間保持可用。"""
+    client = openai.OpenAI(
+        api_key=gpt_key,
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100))
+    )
+    atexit.register(client.close)
+    return client
+
+# 固定的評分規則放在 system 訊息，所有請求共用相同前綴以利伺服器端 prompt caching
+SYSTEM_RUBRIC = """
+Use the following rules to respond:
+1. If the comment does not demonstrate the stated characteristic in any way, reply exactly [NaN,NaN] without any additional reasoning or explanation.
+2. Otherwise, rate your agreement with the statement on a scale from 1 to 5:
+- ‘5’ for Strongly Agree
+- ‘4’ for Agree
+- ‘3’ for Neither Agree nor Disagree
+- ‘2’ for Disagree
+- ‘1’ for Strongly Disagree
+Provide your rationale in the format: [Score, Reason], keeping the reason to one short sentence.
+** Please double-check that if the comment does not demonstrate the stated characteristic in any way, your reply is exactly [NaN,NaN] with no extra explanation.
+"""
+
+# 評分規則要求理由只寫一句，回應通常不到 60 tokens，上限保留一倍餘裕；
+# 推理模型的思考 token 也計入 max_completion_tokens，故另給較寬的上限並以
+# reasoning_effort="low" 限制思考量。超過上限被截斷的回應由 _completion_text 視為錯誤
+MAX_OUTPUT_TOKENS           = 128
+MAX_REASONING_OUTPUT_TOKENS = 1024
+_REASONING_PREFIXES         = ("o1", "o3", "o4", "gpt-5")
+
+def _is_reasoning_model(model):
+    # gpt-5-chat-latest 等 "-chat" 版本為一般聊天模型，不接受 reasoning_effort
+    return model.startswith(_REASONING_PREFIXES) and "-chat" not in model
+
+def _completion_kwargs(model):
+    """依模型類型回傳限制輸出長度與隨機性的參數"""
+    if _is_reasoning_model(model):
+        # 推理模型不接受 temperature / top_p
+        return {"reasoning_effort": "low",
+                "max_completion_tokens": MAX_REASONING_OUTPUT_TOKENS}
+    return {"temperature": 0, "top_p": 1, "max_tokens": MAX_OUTPUT_TOKENS}
+
+def _completion_text(completion):
+    """取出回應文字；因達到輸出上限而被截斷的回應格式不完整，視為錯誤"""
+    choice = completion.choices[0]
+    text = (choice.message.content or "").strip()
+    if choice.finish_reason == "length":
+        raise ValueError(f"Response truncated at the output token limit: {text}")
+    return text
+
+def _build_message_text(title, body, product_line_name, property_name, property_type):
+    """構造單筆評論的評分提示訊息（評分規則見 SYSTEM_RUBRIC）。"""
+    return (f"""
+The following is a comment on a {product_line_name} product:
+Title: {title}
+Body: {body}
+Evaluate the comment regarding the product's '{property_name}', which is categorized as a {property_type} feature.
+""")
+
+def rate_comment(title, body, product_line_name, property_name, property_type, gpt_key, model="gpt-4o-mini"):
     """
     使用 GPT 模型對單筆評論進行評分。
 
@@ -18,37 +84,84 @@ def rate_comment(title, body, product_line_name, property_name, property_type, g
       GPT 回應的評分結果字串，格式預期為 "[分數,理由]"，
       若發生錯誤則回傳錯誤訊息。
     """
-    # 建立 OpenAI 客戶端，並指定 API 金鑰
-    client = openai.OpenAI(api_key=gpt_key)
+    # 取得（或建立）此金鑰共用的 OpenAI 客戶端
+    client = _get_client(gpt_key)
 
     # 構造提示訊息
-    message_text = (f"""
-The following is a comment on a {product_line_name} product:
-Title: {title}
-Body: {body}
-Evaluate the comment regarding the product's '{property_name}', which is categorized as a {property_type} feature.
-Use the following rules to respond:
-1. If the comment does not demonstrate the stated characteristic in any way, reply exactly [NaN,NaN] without any additional reasoning or explanation.
-2. Otherwise, rate your agreement with the statement on a scale from 1 to 5:
-- ‘5’ for Strongly Agree
-- ‘4’ for Agree
-- ‘3’ for Neither Agree nor Disagree
-- ‘2’ for Disagree
-- ‘1’ for Strongly Disagree
-Provide your rationale in the format: [Score, Reason].
-** Please double-check that if the comment does not demonstrate the stated characteristic in any way, your reply is exactly [NaN,NaN] with no extra explanation.
-""")
+    message_text = _build_message_text(title, body, product_line_name, property_name, property_type)
 
     try:
         # 呼叫新版 API 來產生回應
         completion = client.chat.completions.create(
             model=model,
             messages=[
-                {"role": "system", "content": "Forget any previous information."},
+                {"role": "system", "content": SYSTEM_RUBRIC},
                 {"role": "user", "content": message_text}
-            ]
+            ],
+            extra_body={"prompt_cache_key": f"rate-v1-{model}"},
+            **_completion_kwargs(model)
         )
         # 根據回應結構取得產生的文字
-        return completion.choices[0].message.content.strip()
+        return _completion_text(completion)
     except Exception as e:
         return f"Error: {e}"
+
+async def rate_comment_async(client, title, body, product_line_name, property_name, property_type,
+                             model="gpt-4o-mini", semaphore=None):
+    """
+    rate_comment 的非同步版本，供批次評分使用。
+
+    參數:
+      client: openai.AsyncOpenAI 客戶端
+      semaphore: 選填的 asyncio.Semaphore，用來限制同時進行的請求數
+      其餘參數同 rate_comment
+
+    回傳:
+      同 rate_comment。
+    """
+    message_text = _build_message_text(title, body, product_line_name, property_name, property_type)
+
+    async def _call():
+        completion = await client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": SYSTEM_RUBRIC},
+                {"role": "user", "content": message_text}
+            ],
+            extra_body={"prompt_cache_key": f"rate-v1-{model}"},
+            **_completion_kwargs(model)
+        )
+        return _completion_text(completion)
+
+    try:
+        if semaphore is None:
+            return await _call()
+        async with semaphore:
+            return await _call()
+    except Exception as e:
+        return f"Error: {e}"
+
+def rate_comments(comments, product_line_name, property_name, property_type, gpt_key,
+                  model="gpt-4o-mini", max_concurrency=32):
+    """
+    以 asyncio.gather 並行評分多筆評論。
+
+    參數:
+      comments: 評論清單，每筆為含 "title" 與 "body" 的 dict
+      max_concurrency: 同時進行的最大請求數
+      其餘參數同 rate_comment
+
+    回傳:
+      與 comments 順序相同的評分結果字串清單。
+    """
+    async def _run():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async with openai.AsyncOpenAI(api_key=gpt_key) as client:
+            tasks = [
+                rate_comment_async(client, c["title"], c["body"], product_line_name,
+                                   property_name, property_type, model=model, semaphore=semaphore)
+                for c in comments
+            ]
+            return await asyncio.gather(*tasks)
+
+    return list(asyncio.run(_run()))
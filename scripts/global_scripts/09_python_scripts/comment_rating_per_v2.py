@@ -2,94 +2,418 @@
 import openai
 
 # comment2duck_raw.py
-import re, time, openai, duckdb, pandas as pd
+import re, time, asyncio, hashlib, httpx, openai, duckdb, numpy as np, pandas as pd
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import List, Dict, Tuple
 
+# 評分規則與輸出長度參數與 R 端使用的 comment_rating_per.py 共用同一份定義
+from comment_rating_per import (SYSTEM_RUBRIC, _build_message_text, _completion_kwargs,
+                                _completion_text)
+
+try:
+    import tiktoken
+except ImportError:      # 未安裝 tiktoken 時改以字元數粗估 token 數
+    tiktoken = None
+
+try:
+    import faiss
+except ImportError:      # 未安裝 faiss 時改以 numpy 內積做相同的暴力搜尋
+    faiss = None
+
 DB_PATH, TABLE_NAME = "amazon.duckdb", "comment_score"
 
+# 評分 → 寫入 pipeline
+NUM_SCORERS  = 20        # 同時評分的 scorer 數
+QUEUE_SIZE   = 1000      # 待寫入佇列上限，寫入較慢時讓 scorer 暫停
+WRITE_BATCH  = 1000      # writer 每累積此筆數寫入一次 DuckDB
+
+# 速率限制（依帳號等級調整）
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE   = 200_000
+MAX_ATTEMPTS            = 5
+RATE_LIMIT_PAUSE_SEC    = 15
+RETRY_BASE_SEC          = 1       # 重試間隔自此起算，每次加倍
+RETRY_MAX_SEC           = 30
+# 逾時、衝突、429 與 5xx 可重試；其餘 4xx（參數錯誤、金鑰無效等）重試也不會成功
+_RETRY_STATUS           = {408, 409, 429}
+
+# 回應格式 "[分數, 理由]"；理由可能跨行，故使用 DOTALL
+_RESP_RE  = re.compile(r"\[\s*(\d)\s*,\s*(.+?)\s*\]\Z", re.DOTALL)
+_NAN_RESP = "[NaN,NaN]"
+
+# 寫入欄位順序需與 CREATE TABLE 一致（id 與 scored_at 由預設值產生）
+SCORE_COLS   = ["title", "body", "property", "score", "reason", "raw_resp", "source"]
+# 字串欄位以 Arrow 連續緩衝區儲存，可零複製交給 DuckDB
+SCORE_DTYPES = {"title": "string[pyarrow]", "body": "string[pyarrow]",
+                "property": "string[pyarrow]", "score": "Int8",
+                "reason": "string[pyarrow]", "raw_resp": "string[pyarrow]",
+                "source": "string[pyarrow]"}
+
+# 語意快取：相似度超過門檻的近似重複評論沿用先前評分
+EMBED_MODEL        = "text-embedding-3-small"
+EMBED_BATCH        = 256
+EMBED_MAX_RETRIES  = 2      # embedding 請求不經 Rater 重試，改用 SDK 內建重試
+SEMANTIC_THRESHOLD = 0.95
+
 # ──────────────────────────────────────────────────────────────
-def rate_comment(title: str, body: str, product_line_name: str,
-                 propertyname: str, propertytype: str,
-                 gpt_key: str, model: str = "o4-mini"
-) -> Tuple[int | None, str, str]:
+@lru_cache(maxsize=4)
+def _get_client(gpt_key: str) -> openai.AsyncOpenAI:
     """
-    使用 GPT 模型對單筆評論進行評分。
-
-    參數:
-      title: 評論標題
-      body: 評論內容
-      product_line_name: 生產線名稱
-      propertyname: 要評分的屬性名稱
-      propertytype: 評分類別，例如 "屬性" 或 "品牌個性"
-      gpt_key: GPT API 金鑰
-      model: 使用的 GPT 模型，預設為 "gpt-4o-mini"
+    同一金鑰共用一個 AsyncOpenAI 客戶端，讓連線池與 TLS 連線在多次請求間保持可用。
+    httpx 的連線綁定在建立時的 event loop 上，故須在同一個 loop 結束前以
+    Rater.aclose 關閉。
 
-    回傳:
-      GPT 回應的評分結果字串，格式預期為 "[分數,理由]"，
-      若發生錯誤則回傳錯誤訊息。
-     (score, reason, raw_resp)
+    關閉 SDK 內建重試（max_retries=0），由 Rater._create 配合 RateLimiter 重試，
+    讓 429 立即回報給 limiter，且每次 HTTP 請求都對應一次漏桶扣除。
     """
-    client = openai.OpenAI(api_key=gpt_key)
-
-    # ↓↓↓ 你的訊息文字：完全保留
-    message_text = f"""
-The following is a comment on a {product_line_name} product:
-Title: {title}
-Body: {body}
-Evaluate the comment regarding the product's '{propertyname}', which is categorized as a {propertytype} feature.
-Use the following rules to respond:
-1. If the comment does not demonstrate the stated characteristic in any way, reply exactly [NaN,NaN] without any additional reasoning or explanation.
-2. Otherwise, rate your agreement with the statement on a scale from 1 to 5:
-- ‘5’ for Strongly Agree
-- ‘4’ for Agree
-- ‘3’ for Neither Agree nor Disagree
-- ‘2’ for Disagree
-- ‘1’ for Strongly Disagree
-Provide your rationale in the format: [Score, Reason].
-** Please double-check that if the comment does not demonstrate the stated characteristic in any way, your reply is exactly [NaN,NaN] with no extra explanation.
-"""
+    return openai.AsyncOpenAI(
+        api_key=gpt_key,
+        max_retries=0,
+        http_client=httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100))
+    )
 
+@lru_cache(maxsize=8)
+def _encoding(model: str):
     try:
-        resp = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "Forget any previous information."},
-                {"role": "user",   "content": message_text}
-            ]
-        )
-        raw = resp.choices[0].message.content.strip()
-
-        if raw == "[NaN,NaN]":
-            return None, "", raw
-        m = re.match(r"\[\s*(\d)\s*,\s*(.+?)\s*\]$", raw)
-        if not m:
-            raise ValueError(f"Unexpected format: {raw}")
-        return int(m.group(1)), m.group(2), raw
-    except Exception as e:
-        print("GPT error:", e)
-        return None, "", f"Error: {e}"
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def num_tokens(text: str, model: str) -> int:
+    """估算提示訊息的 token 數；未安裝 tiktoken 時以每 4 字元 1 token 粗估。"""
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    return len(_encoding(model).encode(text))
+
+def _is_retryable(e: openai.APIError) -> bool:
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in _RETRY_STATUS or e.status_code >= 500
+    return isinstance(e, openai.APIConnectionError)
+
+def prompt_key(model: str, message_text: str) -> bytes:
+    """GPT 快取鍵：模型名稱 + 提示訊息的 SHA-256"""
+    return hashlib.sha256((model + message_text).encode()).digest()
+
+def cache_get(con: duckdb.DuckDBPyConnection,
+              key: bytes) -> Tuple[str, np.ndarray | None] | None:
+    """回傳 (raw_resp, 評論的 embedding)；embedding 未儲存時為 None，未命中回傳 None"""
+    hit = con.execute("SELECT raw_resp, embedding FROM gpt_cache WHERE prompt_sha256 = ?",
+                      [key]).fetchone()
+    if not hit:
+        return None
+    return hit[0], (np.asarray(hit[1], dtype="float32") if hit[1] is not None else None)
+
+def cache_put(con: duckdb.DuckDBPyConnection, key: bytes, model: str, raw: str,
+              vec: np.ndarray | None = None):
+    con.execute("""
+        INSERT OR IGNORE INTO gpt_cache (prompt_sha256, model, raw_resp, embedding)
+        VALUES (?, ?, ?, ?)
+    """, [key, model, raw, vec.tolist() if vec is not None else None])
+
+async def embed_texts(client: openai.AsyncOpenAI, texts: List[str],
+                      model: str = EMBED_MODEL) -> np.ndarray:
+    """以每 EMBED_BATCH 筆一次請求取得 embedding，回傳 L2 正規化後的矩陣"""
+    # _get_client 關閉了 SDK 重試；embedding 沒有自己的重試迴圈，故逐請求重新開啟
+    client = client.with_options(max_retries=EMBED_MAX_RETRIES)
+    vecs = []
+    for start in range(0, len(texts), EMBED_BATCH):
+        resp = await client.embeddings.create(
+            input=texts[start:start + EMBED_BATCH], model=model)
+        vecs.extend(d.embedding for d in resp.data)
+    mat = np.asarray(vecs, dtype="float32")
+    return mat / np.linalg.norm(mat, axis=1, keepdims=True).clip(min=1e-12)
+
+class SemanticCache:
+    """
+    近似重複評論的語意快取。
+
+    每個 (產品線, 屬性, 類別, 模型) 各自維護一個內積索引（faiss.IndexFlatIP，
+    未安裝 faiss 時以 numpy 計算），向量皆已 L2 正規化，內積即 cosine 相似度。
+    numpy 版本將向量存在預先配置、容量不足時加倍的 float32 矩陣中，
+    查詢只需一次 mat[:n] @ vec。
+    """
+
+    INIT_ROWS = 1024
+
+    def __init__(self, threshold: float = SEMANTIC_THRESHOLD):
+        self.threshold = threshold
+        self._vectors: Dict[tuple, object] = {}
+        self._raws: Dict[tuple, List[str]] = {}
+
+    def lookup(self, key: tuple, vec: np.ndarray) -> str | None:
+        """回傳最相似且超過門檻的已快取回應，否則 None"""
+        raws = self._raws.get(key)
+        if not raws:
+            return None
+        index = self._vectors[key]
+        if faiss is not None:
+            sims, ids = index.search(vec.reshape(1, -1), 1)
+            sim, i = float(sims[0, 0]), int(ids[0, 0])
+        else:
+            sims = index[:len(raws)] @ vec
+            i = int(sims.argmax())
+            sim = float(sims[i])
+        return raws[i] if sim >= self.threshold else None
+
+    def add(self, key: tuple, vec: np.ndarray, raw: str):
+        if key not in self._raws:
+            self._vectors[key] = (faiss.IndexFlatIP(vec.shape[0]) if faiss is not None
+                                  else np.empty((self.INIT_ROWS, vec.shape[0]), dtype="float32"))
+            self._raws[key] = []
+        raws = self._raws[key]
+        if faiss is not None:
+            self._vectors[key].add(vec.reshape(1, -1))
+        else:
+            mat, n = self._vectors[key], len(raws)
+            if n == len(mat):
+                grown = np.empty((2 * n, mat.shape[1]), dtype="float32")
+                grown[:n] = mat
+                self._vectors[key] = mat = grown
+            mat[n] = vec
+        raws.append(raw)
+
+class RateLimiter:
+    """
+    依每分鐘請求數 / token 數主動節流，移植自 openai-cookbook 的
+    api_request_parallel_processor.py。
+
+    兩個漏桶 available_request_capacity / available_token_capacity 以
+    每秒 max/60 的速度回補；收到 429 時記錄 time_of_last_rate_limit_error，
+    之後 RATE_LIMIT_PAUSE_SEC 秒內暫停發出新請求。
+    """
+
+    def __init__(self,
+                 max_requests_per_minute: float = MAX_REQUESTS_PER_MINUTE,
+                 max_tokens_per_minute: float = MAX_TOKENS_PER_MINUTE):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute   = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity   = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self.time_of_last_rate_limit_error = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60,
+            self.max_requests_per_minute)
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60,
+            self.max_tokens_per_minute)
+        self.last_update_time = now
+
+    async def acquire(self, tokens: int):
+        """等待兩個漏桶皆有足夠容量後扣除；以 Lock 讓等待中的請求依序放行。"""
+        tokens = min(tokens, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                pause = (self.time_of_last_rate_limit_error
+                         + RATE_LIMIT_PAUSE_SEC - time.monotonic())
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                self._refill()
+                if (self.available_request_capacity >= 1
+                        and self.available_token_capacity >= tokens):
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity   -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute,
+                    (tokens - self.available_token_capacity) * 60 / self.max_tokens_per_minute,
+                    0.001)
+                await asyncio.sleep(wait)
+
+    def note_rate_limit(self):
+        self.time_of_last_rate_limit_error = time.monotonic()
+
+# ──────────────────────────────────────────────────────────────
+@dataclass
+class Rater:
+    """
+    評分器：建立一次 AsyncOpenAI 客戶端後重複使用，並讓連線池、semaphore、
+    RateLimiter 與各種快取在所有請求間共用，不必在每次呼叫時傳遞 API 金鑰。
+
+    欄位:
+      client: openai.AsyncOpenAI 客戶端（建議使用 _get_client(key) 取得共用連線池者）
+      model: 使用的 GPT 模型，預設為 "gpt-4o-mini"
+      sem: 選填的 asyncio.Semaphore，限制同時進行的請求數；None 表示由呼叫端控制
+           （main 中同時請求數即 NUM_SCORERS）
+      limiter: 依每分鐘請求數 / token 數節流的 RateLimiter；None 表示不節流
+      cache_con: 選填的 DuckDB 連線；相同 (model, 提示訊息) 直接取用 gpt_cache 中的回應
+      semantic: 選填的 SemanticCache；搭配 rate() 的 vec 沿用近似重複評論的評分
+    """
+    client: openai.AsyncOpenAI
+    model: str = "gpt-4o-mini"
+    sem: asyncio.Semaphore | None = None
+    limiter: RateLimiter | None = field(default_factory=RateLimiter)
+    cache_con: duckdb.DuckDBPyConnection | None = None
+    semantic: SemanticCache | None = None
+
+    async def aclose(self):
+        """
+        關閉客戶端的連線池；同時清空 _get_client 的快取，避免之後再取回已關閉的客戶端。
+        """
+        await self.client.close()
+        _get_client.cache_clear()
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        """以共用的客戶端取得正規化 embedding，供 rate() 的 vec 使用"""
+        return await embed_texts(self.client, texts)
+
+    def _prompt(self, title: str, body: str, product_line_name: str,
+                propertyname: str, propertytype: str) -> Tuple[str, bytes]:
+        """回傳 (提示訊息, gpt_cache 快取鍵)"""
+        message_text = _build_message_text(title, body, product_line_name,
+                                           propertyname, propertytype)
+        return message_text, prompt_key(self.model, SYSTEM_RUBRIC + message_text)
+
+    def warm(self, title: str, body: str, product_line_name: str,
+             propertyname: str, propertytype: str) -> bool:
+        """
+        查詢 gpt_cache 是否已有此評論的回應。命中且有儲存 embedding 時一併放入
+        語意快取，讓重跑時的近似重複評論也能沿用；呼叫端只需為未命中者取得 embedding。
+        """
+        if self.cache_con is None:
+            return False
+        hit = cache_get(self.cache_con, self._prompt(
+            title, body, product_line_name, propertyname, propertytype)[1])
+        if hit is None:
+            return False
+        raw, vec = hit
+        if self.semantic is not None and vec is not None:
+            self.semantic.add((product_line_name, propertyname, propertytype, self.model),
+                              vec, raw)
+        return True
+
+    async def _create(self, message_text: str):
+        completion_kwargs = _completion_kwargs(self.model)
+        # 與 cookbook 相同，以提示 token 數加上輸出上限估算此請求的 token 用量
+        n_tokens = (num_tokens(SYSTEM_RUBRIC + message_text, self.model)
+                    + completion_kwargs.get("max_tokens",
+                                            completion_kwargs.get("max_completion_tokens", 0)))
+        # 每個任務各自保有剩餘重試次數；429 時通知 limiter 暫停新請求，
+        # 不可重試的錯誤立即拋出，其餘以指數退避等待後重試
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if self.limiter is not None:
+                await self.limiter.acquire(n_tokens)
+            try:
+                return await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[
+                        {"role": "system", "content": SYSTEM_RUBRIC},
+                        {"role": "user",   "content": message_text}
+                    ],
+                    extra_body={"prompt_cache_key": f"rate-v1-{self.model}"},
+                    **completion_kwargs
+                )
+            except openai.APIError as e:
+                if isinstance(e, openai.RateLimitError) and self.limiter is not None:
+                    self.limiter.note_rate_limit()
+                if attempt == MAX_ATTEMPTS or not _is_retryable(e):
+                    raise
+            await asyncio.sleep(min(RETRY_BASE_SEC * 2 ** (attempt - 1), RETRY_MAX_SEC))
+
+    async def rate(self, title: str, body: str, product_line_name: str,
+                   propertyname: str, propertytype: str,
+                   vec: np.ndarray | None = None
+    ) -> Tuple[int | None, str, str, str]:
+        """
+        使用 GPT 模型對單筆評論進行評分。依序查 gpt_cache、語意快取，皆未命中才呼叫 GPT；
+        只有實際呼叫 GPT 取得的回應寫回 gpt_cache（連同 vec）。語意快取沿用的是另一筆
+        評論的回應，不寫入 gpt_cache，以免調高門檻或停用語意快取後無法重新評分。
+
+        參數:
+          title: 評論標題
+          body: 評論內容
+          product_line_name: 生產線名稱
+          propertyname: 要評分的屬性名稱
+          propertytype: 評分類別，例如 "屬性" 或 "品牌個性"
+          vec: 「title + 換行 + body」經 embed() 取得的正規化向量，供語意快取使用
+
+        回傳:
+          (score, reason, raw_resp, source)；raw_resp 為 GPT 回應的原始字串，格式預期為
+          "[分數,理由]"，若發生錯誤則為錯誤訊息。source 為回應來源：
+          "gpt"、"cache"（gpt_cache）、"semantic"（沿用近似評論）或 "error"。
+        """
+        message_text, key = self._prompt(title, body, product_line_name,
+                                         propertyname, propertytype)
+        hit = cache_get(self.cache_con, key) if self.cache_con is not None else None
+        raw = hit[0] if hit else None
+        source = "cache" if raw is not None else "gpt"
+        use_semantic = self.semantic is not None and vec is not None
+        sem_key = (product_line_name, propertyname, propertytype, self.model)
+
+        try:
+            if source == "gpt":
+                async with self.sem or nullcontext():
+                    # 在取得 semaphore 後才查語意快取，讓排隊中的任務能用到先完成的結果
+                    hit = self.semantic.lookup(sem_key, vec) if use_semantic else None
+                    if hit is not None:
+                        raw, source = hit, "semantic"
+                    else:
+                        resp = await self._create(message_text)
+                        raw = _completion_text(resp)
+
+            if raw == _NAN_RESP:
+                score, reason = None, ""
+            else:
+                m = _RESP_RE.match(raw)
+                if not m:
+                    raise ValueError(f"Unexpected format: {raw}")
+                score, reason = int(m.group(1)), m.group(2)
+
+            # 只快取格式正確的回應，格式錯誤者下次重新呼叫
+            if source == "gpt" and self.cache_con is not None:
+                cache_put(self.cache_con, key, self.model, raw, vec)
+            if source != "cache" and use_semantic:
+                self.semantic.add(sem_key, vec, raw)
+            return score, reason, raw, source
+        except Exception as e:
+            print("GPT error:", e)
+            return None, "", f"Error: {e}", "error"
 
 # ──────────────────────────────────────────────────────────────
 def init_db(db_path: str = "amazon.duckdb",
             table_name: str = "comment_score",
             overwrite: bool = False):
-    import os, pathlib
-    if overwrite and pathlib.Path(db_path).exists():
-        os.remove(db_path)
-
     con = duckdb.connect(db_path)
+    # overwrite 只重建評分表（連同其 id sequence），同一資料庫中的 gpt_cache 等其他表保留
+    if overwrite:
+        con.execute(f"DROP TABLE IF EXISTS {table_name}")
+        con.execute(f"DROP SEQUENCE IF EXISTS {table_name}_id_seq")
+    # DuckDB 不支援 GENERATED ALWAYS AS IDENTITY，改以 sequence 產生 id
+    con.execute(f"CREATE SEQUENCE IF NOT EXISTS {table_name}_id_seq")
     con.execute(f"""
         CREATE TABLE IF NOT EXISTS {table_name} (
-          id BIGINT GENERATED ALWAYS AS IDENTITY,
+          id BIGINT DEFAULT nextval('{table_name}_id_seq'),
           title     TEXT,
           body      TEXT,
           property  TEXT,
           score     INTEGER,
           reason    TEXT,
           raw_resp  TEXT,
+          source    TEXT,
           scored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    # 舊版建立的評分表沒有 source 欄位
+    con.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS source TEXT")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS gpt_cache (
+          prompt_sha256 BLOB PRIMARY KEY,
+          model         TEXT,
+          raw_resp      TEXT,
+          embedding     FLOAT[]
+        )
+    """)
+    # 舊版建立的 gpt_cache 沒有 embedding 欄位
+    con.execute("ALTER TABLE gpt_cache ADD COLUMN IF NOT EXISTS embedding FLOAT[]")
     return con
 
 def write_rows(con: duckdb.DuckDBPyConnection,
@@ -97,16 +421,12 @@ def write_rows(con: duckdb.DuckDBPyConnection,
                table_name: str = "comment_score"):
     if not rows:
         return
-    df = pd.DataFrame(rows)
-    con.register("tmp", df)
-    con.execute(f"""
-        INSERT INTO {table_name}
-        SELECT title, body, property, score, reason, raw_resp FROM tmp
-    """)
-    con.unregister("tmp")
+    df = pd.DataFrame(rows, columns=SCORE_COLS).astype(SCORE_DTYPES)
+    # 以 appender 直接寫入；批次大小由呼叫端控制（writer 每次 WRITE_BATCH 筆）
+    con.append(table_name, df, by_name=True)
 
 # ──────────────────────────────────────────────────────────────
-def main(db_path: str = "amazon.duckdb",
+async def main(db_path: str = "amazon.duckdb",
          table_name: str = "comment_score",
          overwrite: bool = False):
     GPT_KEY = "sk-..."   # ← 填入你的 key
@@ -117,24 +437,66 @@ def main(db_path: str = "amazon.duckdb",
         {"title": "Too salty", "body": "I can’t take it every day…"},
     ]
 
-    con  = init_db(db_path, table_name, overwrite)
-    rows = []
+    con = init_db(db_path, table_name, overwrite)
+
+    # 只在此處使用一次金鑰；客戶端、節流與快取狀態由 rater 共用
+    rater = Rater(_get_client(GPT_KEY), cache_con=con, semantic=SemanticCache())
+
+    # producer → in_q → NUM_SCORERS 個 scorer → out_q → writer
+    # 評分與寫入 DuckDB 同時進行；同時請求數由 scorer 數量控制
+    in_q:  asyncio.Queue = asyncio.Queue()
+    out_q: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async def producer():
+        for start in range(0, len(comments), EMBED_BATCH):
+            window = comments[start:start + EMBED_BATCH]
+            # 已在 gpt_cache 的評論不需 embedding（並以其儲存的向量預先填入語意快取）；
+            # 其餘每個視窗一次取得 embedding，失敗時僅略過語意快取
+            misses = [c for c in window
+                      if not rater.warm(c["title"], c["body"], PRODUCT, PROP_NAME, PROP_TYPE)]
+            vecs = {}
+            if misses:
+                try:
+                    mat = await rater.embed([f"{c['title']}\n{c['body']}" for c in misses])
+                    vecs = {id(c): v for c, v in zip(misses, mat)}
+                except Exception as e:
+                    print("Embedding error:", e)
+            for c in window:
+                await in_q.put((c, vecs.get(id(c))))
+        for _ in range(NUM_SCORERS):
+            await in_q.put(None)
+
+    async def scorer():
+        while (item := await in_q.get()) is not None:
+            c, v = item
+            score, reason, raw, source = await rater.rate(
+                c["title"], c["body"],
+                PRODUCT, PROP_NAME, PROP_TYPE, vec=v)
+            await out_q.put({
+                "title": c["title"], "body": c["body"],
+                "property": PROP_NAME,
+                "score": score, "reason": reason,
+                "raw_resp": raw, "source": source
+            })
+
+    async def writer():
+        chunk = []
+        while (row := await out_q.get()) is not None:
+            chunk.append(row)
+            if len(chunk) >= WRITE_BATCH:
+                write_rows(con, chunk, table_name)
+                chunk = []
+        write_rows(con, chunk, table_name)
+
+    async def score_all():
+        await asyncio.gather(producer(), *(scorer() for _ in range(NUM_SCORERS)))
+        await out_q.put(None)
+
+    try:
+        await asyncio.gather(score_all(), writer())
+    finally:
+        await rater.aclose()
 
-    for c in comments:
-        score, reason, raw = rate_comment(
-            c["title"], c["body"],
-            PRODUCT, PROP_NAME, PROP_TYPE,
-            gpt_key=GPT_KEY
-        )
-        rows.append({
-            "title": c["title"], "body": c["body"],
-            "property": PROP_NAME,
-            "score": score, "reason": reason,
-            "raw_resp": raw
-        })
-        time.sleep(1.2)
-
-    write_rows(con, rows, table_name)
     print(con.execute(f"SELECT id,title,score FROM {table_name}").fetch_df())
     con.close()
 
@@ -145,9 +507,9 @@ if __name__ == "__main__":
     ap.add_argument("--db_path",    default="amazon.duckdb")
     ap.add_argument("--table_name", default="comment_score")
     ap.add_argument("--overwrite",  action="store_true",
-                    help="Delete existing DB before run")
+                    help="Drop the existing score table before run")
     args = ap.parse_args()
 
-    main(db_path=args.db_path,
-         table_name=args.table_name,
-         overwrite=args.overwrite)
+    asyncio.run(main(db_path=args.db_path,
+                     table_name=args.table_name,
+                     overwrite=args.overwrite))